@@ -23,14 +23,39 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 #
 
-import traceback
 import MDSplus
+import concurrent.futures
+import functools
 import numpy as np
 import socket
 import threading
 import time
 import queue
 
+def _forget_uut_on_error(method):
+    """Drop the cached connections to the digitizer when a method fails with a socket error, so the next call reconnects"""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        try:
+            return method(self, *args, **kwargs)
+        except OSError:
+            self._forget_uut()
+            raise
+
+    return wrapper
+
+def _report_thread_exception(thread, e):
+    """Keep an exception raised by one of the device's threads for whoever joins it, and print the traceback"""
+    thread.exception = e
+
+    # The connection may have died, so don't let it be reused
+    device = getattr(thread, 'device', None)
+    if isinstance(e, OSError) and device is not None:
+        device._forget_uut()
+
+    import traceback
+    traceback.print_exc()
+
 class ACQ2106(MDSplus.Device):
     '''
     # ACQ2106 Device Driver
@@ -165,6 +190,29 @@ class ACQ2106(MDSplus.Device):
     _MAX_SPAD = 8
     """The maximum number of scratchpad (SPAD) channels that can be configured"""
 
+    _MAX_CHANNELS_PER_SITE = 32
+    """The maximum number of inputs or outputs on a single module"""
+
+    _INPUT_SUFFIXES = tuple(f":INPUT_{index + 1:02}" for index in range(_MAX_CHANNELS_PER_SITE))
+    """Path suffixes for the inputs of a site, e.g. _INPUT_SUFFIXES[0] is :INPUT_01"""
+
+    _OUTPUT_SUFFIXES = tuple(f":OUTPUT_{index + 1:02}" for index in range(_MAX_CHANNELS_PER_SITE))
+    """Path suffixes for the outputs of a site, e.g. _OUTPUT_SUFFIXES[0] is :OUTPUT_01"""
+
+    _AGGREGATED_INPUT_SUFFIXES = tuple(f":INPUT_{index + 1:03}" for index in range(_MAX_SITES * _MAX_CHANNELS_PER_SITE))
+    """Path suffixes for the aggregated inputs under :INPUTS, e.g. _AGGREGATED_INPUT_SUFFIXES[0] is :INPUT_001"""
+
+    _MODULE_INFO = {
+        'ACQ435ELF': { 'nchan': 32, 'dtype': '', 'input': True, 'output': False },
+        'ACQ423ELF': { 'nchan': 32, 'dtype': '', 'input': True, 'output': False },
+        'ACQ482ELF': { 'nchan': 8, 'dtype': '', 'input': True, 'output': False },
+        'ACQ424ELF': { 'nchan': 32, 'dtype': '', 'input': False, 'output': True },
+    }
+    """The number of channels and the direction of each of the supported modules, see _get_module_info"""
+
+    _INPUT_MODULE_NCHAN = { model: info['nchan'] for model, info in _MODULE_INFO.items() if info['input'] }
+    """The number of inputs on each of the supported input modules"""
+
     _MODE_OPTIONS = [
         'STREAM',
         'TRANSIENT',
@@ -236,6 +284,24 @@ class ACQ2106(MDSplus.Device):
     _MONITOR_DELAY_SECONDS = 30
     """The delay in seconds between each record made by the Monitor"""
 
+    _STREAM_BUFFER_COUNT = 4
+    """The number of segment buffers allocated up front when streaming, more are allocated if the StreamWriter can't keep up"""
+
+    _STREAM_SOCKET_BUFFER_SIZE = 4 * 1024 * 1024
+    """The minimum size in bytes of the kernel receive buffer (SO_RCVBUF) requested for the streaming socket"""
+
+    _UUT_CACHE_SECONDS = 30
+    """The time in seconds that a connection to the digitizer is reused before _get_uut creates a new one"""
+
+    _POST_PROCESSING_TIMEOUT_SECONDS = 60
+    """The maximum time in seconds that store_transient will wait for the digitizer to finish post-processing"""
+
+    _POST_PROCESSING_MIN_POLL_SECONDS = 0.01
+    """The initial delay in seconds between each post-processing state check, doubled after every check"""
+
+    _POST_PROCESSING_MAX_POLL_SECONDS = 0.25
+    """The maximum delay in seconds between each post-processing state check"""
+
     ###
     ### Parts
     ###
@@ -285,7 +351,8 @@ class ACQ2106(MDSplus.Device):
     ]
 
     # Any additional parts that are needed, but are not included in the bare bones parts array above go here.
-    _default_parts = [
+    # These are tuples so that they can be shared safely, they should never be modified at runtime.
+    _default_parts = (
         {
             'path': ':SERIAL',
             'type': 'text',
@@ -428,16 +495,9 @@ class ACQ2106(MDSplus.Device):
                 'tooltip': 'If present, this scratchpad field will contain part of the TAI timestamp.',
             },
         },
-    ]
+    )
 
-    for _spad_index in range(3, _MAX_SPAD):
-        _default_parts.append({
-            'path': f":SCRATCHPAD:SPAD{_spad_index}",
-            'type': 'signal',
-            'options': ('no_write_model',),
-        })
-
-    _stream_parts = [
+    _stream_parts = (
         {
             'path': ':STREAM',
             'type': 'structure',
@@ -536,9 +596,9 @@ class ACQ2106(MDSplus.Device):
                 'min': 1,
             },
         },
-    ]
+    )
 
-    _transient_parts = [
+    _transient_parts = (
         {
             'path': ':TRANSIENT',
             'type': 'structure',
@@ -591,9 +651,9 @@ class ACQ2106(MDSplus.Device):
                 'tooltip': 'An action that can be used to call store_transient().',
             },
         },
-    ]
+    )
 
-    _wr_parts = [
+    _wr_parts = (
         {
             'path': ':WR',
             'type': 'structure',
@@ -679,9 +739,9 @@ class ACQ2106(MDSplus.Device):
             'options': ('no_write_shot',),
             'valueExpr': 'TdiCompile("ACQ2106_PARSE_SPAD_TIMESTAMPS($, $, $)", node.parent.SPAD1, node.parent.SPAD2, head.WR.NS_PER_TICK)'
         },
-    ]
+    )
 
-    _sc_parts = [
+    _sc_parts = (
         {
             'path': ':DEFAULTS:SC_GAIN1',
             'type': 'numeric',
@@ -714,9 +774,9 @@ class ACQ2106(MDSplus.Device):
                 'max': 2.5,
             },
         },
-    ]
+    )
 
-    _32bit_parts = [
+    _32bit_parts = (
         {
             'path': ':HARD_DECIM',
             'type': 'numeric',
@@ -728,11 +788,176 @@ class ACQ2106(MDSplus.Device):
                 'max': 32,
             },
         },
-    ]
+    )
 
-    def _get_parts_for_site(self, site, model, has_sc=False):
-        mode = str(self.MODE.data())
-        
+    @classmethod
+    def _get_default_parts(cls):
+        """Get the _default_parts, followed by the remaining SPAD nodes which have no special meaning."""
+        return cls._default_parts + tuple(
+            {
+                'path': f":SCRATCHPAD:SPAD{spad_index}",
+                'type': 'signal',
+                'options': ('no_write_model',),
+            }
+            for spad_index in range(3, cls._MAX_SPAD)
+        )
+
+    # The parts for a single input, as (path suffix, part) pairs. The path of each part is the path of the input plus the suffix.
+    _input_parts = (
+        (
+            '',
+            {
+                'type': 'signal',
+                'valueExpr': 'head._set_input_segment_scale(node, node.COEFFICIENT, node.OFFSET)',
+            },
+        ),
+        (
+            ':COEFFICIENT',
+            {
+                'type': 'numeric',
+                'options':('no_write_model', 'write_once',),
+                'ext_options': {
+                    'tooltip': 'Calibration coefficient (factor) for this input, queried from the digitizer.',
+                },
+            },
+        ),
+        (
+            ':OFFSET',
+            {
+                'type': 'numeric',
+                'options':('no_write_model', 'write_once',),
+                'ext_options': {
+                    'tooltip': 'Calibration offset for this input, queried from the digitizer.',
+                },
+            },
+        ),
+    )
+
+    # Additional parts for a single input, depending on the mode
+    _input_parts_by_mode = {
+        'STREAM': (
+            (
+                ':RESAMPLED',
+                {
+                    'type': 'signal',
+                    'valueExpr': 'head._set_input_segment_scale(node, node.parent.COEFFICIENT, node.parent.OFFSET)',
+                    'ext_options': {
+                        'tooltip': 'Data for this input, resampled with makeSegmentResampled(RES_FACTOR).',
+                    },
+                },
+            ),
+            (
+                ':RES_FACTOR',
+                {
+                    'type': 'numeric',
+                    'valueExpr': 'head.DEFAULTS.RES_FACTOR',
+                    'ext_options': {
+                        'tooltip': 'Factor for resampling for this input. Set to 1 to disable.',
+                        'min': 1,
+                    },
+                },
+            ),
+            (
+                ':SOFT_DECIM',
+                {
+                    'type': 'numeric',
+                    'valueExpr': 'head.DEFAULTS.SOFT_DECIM',
+                    'options':('no_write_shot',),
+                    'ext_options': {
+                        'tooltip': 'Software decimation for this input, which is computed on the server by discarding every N-1 samples. Set to 1 to disable.',
+                        'min': 1,
+                    },
+                },
+            ),
+        ),
+    }
+
+    # Additional parts for a single input, if the site has slow data
+    # _slow_input_parts = (
+    #     (
+    #         ':SLOW',
+    #         {
+    #             'type': 'signal',
+    #             'options':('no_write_model',),
+    #             'ext_options': {
+    #                 'tooltip': 'The 1Hz slow data, downsampled on the digitizer.',
+    #             },
+    #         },
+    #     ),
+    # )
+
+    # Additional parts for a single input, if the site has signal conditioning
+    _sc_input_parts = (
+        (
+            ':SC_GAIN1',
+            {
+                'type': 'numeric',
+                'valueExpr': 'head.DEFAULTS.SC_GAIN1',
+                'options':('no_write_shot',),
+                'ext_options': {
+                    'tooltip': 'Default signal conditioning gain #1 for this input, which is applied before the offset (SC_OFFSET).',
+                    'values': [ 1, 10, 100, 1000 ],
+                },
+            },
+        ),
+        (
+            ':SC_GAIN2',
+            {
+                'type': 'numeric',
+                'valueExpr': 'head.DEFAULTS.SC_GAIN2',
+                'options':('no_write_shot',),
+                'ext_options': {
+                    'tooltip': 'Signal conditioning gain #2 for this input, which is applied after the offset (SC_OFFSET).',
+                    'values': [ 1, 2, 5, 10 ],
+                },
+            },
+        ),
+        (
+            ':SC_OFFSET',
+            {
+                'type': 'numeric',
+                'valueExpr': 'head.DEFAULTS.SC_OFFSET',
+                'options':('no_write_shot',),
+                'ext_options': {
+                    'tooltip': 'Signal conditioning offset for this input, which is applied after the first gain (SC_GAIN1) and before the second gain (SC_GAIN2).',
+                    'min': -2.5,
+                    'max': 2.5,
+                },
+            },
+        ),
+    )
+
+    _input_parts_templates = {}
+    """Cache of the parts for a single input, keyed by (mode, has_sc). See _get_input_parts_template."""
+
+    @classmethod
+    def _get_input_parts_template(cls, mode, has_sc):
+        """
+        Get the parts for a single input as a tuple of (path suffix, part) pairs. These are identical for every input of
+        every site, so they are only built once per combination of mode and has_sc.
+        """
+        key = (mode, has_sc)
+        if key not in cls._input_parts_templates:
+            template = cls._input_parts + cls._input_parts_by_mode.get(mode, ())
+            if has_sc:
+                template += cls._sc_input_parts
+
+            cls._input_parts_templates[key] = template
+
+        return cls._input_parts_templates[key]
+
+    _site_parts_cache = {}
+    """Cache of the parts for each site, keyed by (site, model, mode, has_sc). See _get_parts_for_site."""
+
+    def _get_parts_for_site(self, site, model, mode, has_sc=False):
+        key = (site, model, mode, has_sc)
+        if key not in self._site_parts_cache:
+            self._site_parts_cache[key] = tuple(self._build_parts_for_site(site, model, mode, has_sc))
+
+        # Copy each part so the caller is free to modify them without changing the cache
+        return [ dict(part) for part in self._site_parts_cache[key] ]
+
+    def _build_parts_for_site(self, site, model, mode, has_sc):
         site_path = f":SITE{site}"
         parts = [
             {
@@ -763,118 +988,17 @@ class ACQ2106(MDSplus.Device):
             },
         ]
 
-        if model == 'ACQ435ELF' or model == 'ACQ423ELF' or model == 'ACQ482ELF':
-            nchan = 32
-            if model == 'ACQ482ELF':
-                nchan = 8
+        if model in self._INPUT_MODULE_NCHAN:
+            nchan = self._INPUT_MODULE_NCHAN[model]
 
-            for input_index in range(nchan):
-                input_path = site_path + f":INPUT_{input_index + 1:02}"
-                parts += [
-                    {
-                        'path': input_path,
-                        'type': 'signal',
-                        'valueExpr': 'head._set_input_segment_scale(node, node.COEFFICIENT, node.OFFSET)',
-                    },
-                    {
-                        'path': input_path + ':COEFFICIENT',
-                        'type': 'numeric',
-                        'options':('no_write_model', 'write_once',),
-                        'ext_options': {
-                            'tooltip': 'Calibration coefficient (factor) for this input, queried from the digitizer.',
-                        },
-                    },
-                    {
-                        'path': input_path + ':OFFSET',
-                        'type': 'numeric',
-                        'options':('no_write_model', 'write_once',),
-                        'ext_options': {
-                            'tooltip': 'Calibration offset for this input, queried from the digitizer.',
-                        },
-                    }
-                ]
-                
-                if mode == 'STREAM':
-                    parts += [
-                        {
-                            'path': input_path + ':RESAMPLED',
-                            'type': 'signal',
-                            'valueExpr': 'head._set_input_segment_scale(node, node.parent.COEFFICIENT, node.parent.OFFSET)',
-                            'ext_options': {
-                                'tooltip': 'Data for this input, resampled with makeSegmentResampled(RES_FACTOR).',
-                            },
-                        },
-                        {
-                            'path': input_path + ':RES_FACTOR',
-                            'type': 'numeric',
-                            'valueExpr': 'head.DEFAULTS.RES_FACTOR',
-                            'ext_options': {
-                                'tooltip': 'Factor for resampling for this input. Set to 1 to disable.',
-                                'min': 1,
-                            },
-                        },
-                        {
-                            'path': input_path + ':SOFT_DECIM',
-                            'type': 'numeric',
-                            'valueExpr': 'head.DEFAULTS.SOFT_DECIM',
-                            'options':('no_write_shot',),
-                            'ext_options': {
-                                'tooltip': 'Software decimation for this input, which is computed on the server by discarding every N-1 samples. Set to 1 to disable.',
-                                'min': 1,
-                            },
-                        },
-                    ]
-
-                # if has_slow:
-                #     parts += [
-                #         {
-                #             'path': input_path + ':SLOW',
-                #             'type': 'signal',
-                #             'options':('no_write_model',),
-                #             'ext_options': {
-                #                 'tooltip': 'The 1Hz slow data, downsampled on the digitizer.',
-                #             },
-                #         },
-                #     ]
-
-                if has_sc:
-                    parts += [
-                        {
-                            'path': input_path + ':SC_GAIN1',
-                            'type': 'numeric',
-                            'valueExpr': 'head.DEFAULTS.SC_GAIN1',
-                            'options':('no_write_shot',),
-                            'ext_options': {
-                                'tooltip': 'Default signal conditioning gain #1 for this input, which is applied before the offset (SC_OFFSET).',
-                                'values': [ 1, 10, 100, 1000 ],
-                            },
-                        },
-                        {
-                            'path': input_path + ':SC_GAIN2',
-                            'type': 'numeric',
-                            'valueExpr': 'head.DEFAULTS.SC_GAIN2',
-                            'options':('no_write_shot',),
-                            'ext_options': {
-                                'tooltip': 'Signal conditioning gain #2 for this input, which is applied after the offset (SC_OFFSET).',
-                                'values': [ 1, 2, 5, 10 ],
-                            },
-                        },
-                        {
-                            'path': input_path + ':SC_OFFSET',
-                            'type': 'numeric',
-                            'valueExpr': 'head.DEFAULTS.SC_OFFSET',
-                            'options':('no_write_shot',),
-                            'ext_options': {
-                                'tooltip': 'Signal conditioning offset for this input, which is applied after the first gain (SC_GAIN1) and before the second gain (SC_GAIN2).',
-                                'min': -2.5,
-                                'max': 2.5,
-                            },
-                        },
-                    ]
+            input_template = self._get_input_parts_template(mode, has_sc)
+            for input_suffix in self._INPUT_SUFFIXES[:nchan]:
+                input_path = site_path + input_suffix
+                parts += [ { 'path': input_path + suffix, **part } for suffix, part in input_template ]
 
         elif model == 'ACQ424ELF':
-            for output_index in range(32):
-                output_path = site_path + f":OUTPUT_{output_index + 1:02}"
+            for output_suffix in self._OUTPUT_SUFFIXES:
+                output_path = site_path + output_suffix
                 parts.append({
                     'path': output_path,
                     'type': 'signal',
@@ -897,8 +1021,8 @@ class ACQ2106(MDSplus.Device):
                 },
             ]
 
-            for output_index in range(32):
-                output_path = site_path + f":OUTPUT_{output_index + 1:02}"
+            for output_suffix in self._OUTPUT_SUFFIXES:
+                output_path = site_path + output_suffix
                 parts += [
                     {
                         'path': output_path,
@@ -921,8 +1045,8 @@ class ACQ2106(MDSplus.Device):
                 },
             ]
 
-            for output_index in range(4):
-                output_path = site_path + f":OUTPUT_{output_index + 1:02}"
+            for output_suffix in self._OUTPUT_SUFFIXES[:4]:
+                output_path = site_path + output_suffix
                 parts += [
                     {
                         'path': output_path,
@@ -938,28 +1062,22 @@ class ACQ2106(MDSplus.Device):
 
         return parts
 
+    def _probe_site(self, client):
+        """Read the model of a site, and its ELFX32 knob if it has one. Called concurrently for every site by configure()"""
+        elfx32 = client.ELFX32 if 'ELFX32' in client.knobs else None
+        return client.MODEL.split(' ')[0], elfx32
+
     def _get_module_info(self, model):
-        info = {
-            'nchan': 0,
-            'dtype': '',
-            'input': False,
-            'output': False,
-        }
-
-        if model == 'ACQ435ELF':
-            info['nchan'] = 32
-            info['input'] = True
-        elif model == 'ACQ423ELF':
-            info['nchan'] = 32
-            info['input'] = True
-        elif model == 'ACQ482ELF':
-            info['nchan'] = 8
-            info['input'] = True
-        elif model == 'ACQ424ELF':
-            info['nchan'] = 32
-            info['output'] = True
+        info = self._MODULE_INFO.get(model)
+        if info is None:
+            return {
+                'nchan': 0,
+                'dtype': '',
+                'input': False,
+                'output': False,
+            }
 
-        return info
+        return dict(info)
 
     # def help(self):
     #     print("""
@@ -1001,19 +1119,26 @@ class ACQ2106(MDSplus.Device):
 
     def _get_calibration(self, uut):
         # In order to get the calibration per-site, we cannot use uut.fetch_all_calibration()
-        for site in list(map(int, uut.get_aggregator_sites())):
+        for site in self._get_aggregator_sites(uut):
             client = uut.modules[site]
 
             self._log_info(f"Reading Calibration for site {site}")
 
-            coefficients = list(map(float, client.AI_CAL_ESLO.split()[3:]))
-            offsets = list(map(float, client.AI_CAL_EOFF.split()[3:]))
+            site_nchan = int(client.NCHAN)
 
-            site_node = self.getNode(f"SITE{site}")
-            for input_index in range(int(client.NCHAN)):
-                input_node = site_node.getNode(f"INPUT_{input_index + 1:02}")
-                input_node.COEFFICIENT.record = coefficients[input_index]
-                input_node.OFFSET.record = offsets[input_index]
+            # The first three values are not calibration values
+            # Converting with tolist() gives Python floats for every input in one call, instead of one float() per input
+            coefficients = np.array(client.AI_CAL_ESLO.split()[3:], dtype='float64')[: site_nchan].tolist()
+            offsets = np.array(client.AI_CAL_EOFF.split()[3:], dtype='float64')[: site_nchan].tolist()
+
+            if len(coefficients) < site_nchan or len(offsets) < site_nchan:
+                raise Exception(f"Calibration for site {site} has fewer values than its {site_nchan} inputs")
+
+            site_path = f":SITE{site}"
+            for input_suffix, coefficient, offset in zip(self._INPUT_SUFFIXES[: site_nchan], coefficients, offsets):
+                input_node = self.getNode(site_path + input_suffix)
+                input_node.COEFFICIENT.record = coefficient
+                input_node.OFFSET.record = offset
 
     _SECONDS_TO_NANOSECONDS = 1_000_000_000
     """One second in nanoseconds"""
@@ -1045,6 +1170,8 @@ class ACQ2106(MDSplus.Device):
             requested_arguments['TRG:DX'] = 'd0'
         elif trigger_source in self._TRIGGER_SOURCE_D1_OPTIONS:
             requested_arguments['TRG:DX'] = 'd1'
+        else:
+            raise Exception(f"Unknown trigger source {trigger_source}, must be one of {self._TRIGGER_SOURCE_D0_OPTIONS + self._TRIGGER_SOURCE_D1_OPTIONS}")
 
         changed = False
 
@@ -1064,7 +1191,7 @@ class ACQ2106(MDSplus.Device):
 
         if changed:
             self._log_info('Reconfiguring sync role, this may take some time.')
-            uut.s0.sync_role = f"{self.SYNC_ROLE.data()} {int(self.FREQUENCY.data())} {self._dict_to_string(requested_arguments)}"
+            uut.s0.sync_role = f"{requested_sync_role} {requested_frequency} {self._dict_to_string(requested_arguments)}"
               
         # snyc_role will set a default trigger source, so we need to set these after
         self._log_info(f"Setting trigger source of timing highway {requested_arguments['TRG:DX']} to {trigger_source}")
@@ -1153,25 +1280,33 @@ class ACQ2106(MDSplus.Device):
     def _set_signal_conditioning_gains(self, uut):
         import epics
 
-        for site in list(map(int, uut.get_aggregator_sites())):
+        for site in self._get_aggregator_sites(uut):
             client = uut.modules[site]
 
             self._log_info(f"Setting Signal Conditioning Gains and Offsets for site {site}")
 
-            site_node = self.getNode(f"SITE{site}")
+            site_path = f":SITE{site}"
             epics_prefix = self.EPICS_NAME.data() + f":{site}:SC32:"
 
-            for input_index in range(int(client.NCHAN)):
-                input_node = site_node.getNode(f"INPUT_{input_index + 1:02}")
+            pv_names = []
+            pv_values = []
+            for input_index, input_suffix in enumerate(self._INPUT_SUFFIXES[: int(client.NCHAN)]):
+                input_node = self.getNode(site_path + input_suffix)
+
+                pv_names.append(epics_prefix + f"G1:{input_index:02}")
+                pv_values.append(str(input_node.SC_GAIN1.data()))
 
-                pv = epics.PV(epics_prefix + f"G1:{input_index:02}")
-                pv.put(str(input_node.SC_GAIN1.data()), wait=True)
+                pv_names.append(epics_prefix + f"G2:{input_index:02}")
+                pv_values.append(str(input_node.SC_GAIN2.data()))
 
-                pv = epics.PV(epics_prefix + f"G2:{input_index:02}")
-                pv.put(str(input_node.SC_GAIN2.data()), wait=True)
+                pv_names.append(epics_prefix + f"OFFSET:{input_index:02}")
+                pv_values.append(str(input_node.SC_OFFSET.data()))
 
-                pv = epics.PV(epics_prefix + f"OFFSET:{input_index:02}")
-                pv.put(str(input_node.SC_OFFSET.data()), wait=True)
+            # Issue all of the puts at once, and then wait for all of them to complete
+            statuses = epics.caput_many(pv_names, pv_values, wait='all')
+            for pv_name, status in zip(pv_names, statuses):
+                if status != 1:
+                    self._log_error(f"Failed to set {pv_name}")
 
             self._log_verbose(f"Comitting Signal Conditioning Gains and Offsets for site {site}")
 
@@ -1181,6 +1316,13 @@ class ACQ2106(MDSplus.Device):
     def _setup_pulse_generators(self, uut):
         _DIO_MODELS = ['DIO482ELF', 'DIO482ELF_TD']
 
+        highway = None
+        trigger_source = str(self.TRIGGER.SOURCE.data()).upper()
+        if trigger_source in self._TRIGGER_SOURCE_D0_OPTIONS:
+            highway = 'd0'
+        elif trigger_source in self._TRIGGER_SOURCE_D1_OPTIONS:
+            highway = 'd1'
+
         for site, client in sorted(uut.modules.items()):
             site_node = self.getNode(f"SITE{site}")
             model = str(site_node.MODEL.data()) # or get it from the uut ?
@@ -1195,14 +1337,6 @@ class ACQ2106(MDSplus.Device):
             except:
                 pass
             
-            highway = None
-            trigger_source = str(self.TRIGGER.SOURCE.data()).upper()
-            if trigger_source in self._TRIGGER_SOURCE_D0_OPTIONS:
-                highway = 'd0'
-            elif trigger_source in self._TRIGGER_SOURCE_D1_OPTIONS:
-                highway = 'd1'
-
-            
             client.TRG        = 'enable'
             client.TRG_DX     = highway
             client.TRG_SENSE  = 'rising'
@@ -1225,53 +1359,55 @@ class ACQ2106(MDSplus.Device):
                 if 'DO_5' in client.help():
                     nchan = 5
             
+            times_by_chan = []
             data_by_chan = []
-            all_times = []
 
             for output_index in range(nchan):
                 chan_node = site_node.getNode(f"OUTPUT_{output_index + 1:02}")
 
-                times = chan_node.dim_of().data()
-                data = chan_node.data()
-
-                # Build dictionary of times -> states
-                data_dict = dict(zip(times, data))
+                times_by_chan.append(np.asarray(chan_node.dim_of().data()))
+                data_by_chan.append(np.asarray(chan_node.data()))
 
-                data_by_chan.append(data_dict)
-                all_times.extend(times)
-
-            all_times = sorted(list(set(all_times)))
+            # Sorted, unique transition times across all channels
+            all_times = np.unique(np.concatenate(times_by_chan))
+            row_indices = np.arange(len(all_times))
 
             # initialize the state matrix
             state_matrix = np.zeros((len(all_times), nchan), dtype='int')
 
-            for c, data in enumerate(data_by_chan):
-                for t, time in enumerate(all_times):
-                    if time in data:
-                        state_matrix[t][c] = data[time]
-                    else:
-                        state_matrix[t][c] = state_matrix[t - 1][c]
-
-            # Building the string of 1s and 0s for each transition time:
-            binary_rows = []
-            times_usecs = []
-            last_row = None
-            for time, row in zip(all_times, state_matrix):
-                if not np.array_equal(row, last_row):
-                    rowstr = [ str(i) for i in np.flip(row) ]  # flipping the bits so that chan 1 is in the far right position
-                    binary_rows.append(''.join(rowstr))
-                    times_usecs.append(int(time * 1E7)) # Converting the original units of the transtion times in seconds, to 1/10th micro-seconds
-                    last_row = row
+            for c, (times, data) in enumerate(zip(times_by_chan, data_by_chan)):
+                # Every time of this channel is in all_times, so this finds its row in the state matrix
+                known_rows = np.searchsorted(all_times, times)
+
+                states = np.zeros(len(all_times), dtype='int')
+                states[known_rows] = data
+
+                is_known = np.zeros(len(all_times), dtype=bool)
+                is_known[known_rows] = True
+
+                # Forward-fill every time without a transition with the last known state of this channel
+                # Rows before the first transition point at row 0, which is either known or still 0
+                last_known_row = np.maximum.accumulate(np.where(is_known, row_indices, 0))
+                state_matrix[:, c] = states[last_known_row]
+
+            # Only keep the rows where at least one channel changes state, the first row is always kept
+            is_transition = np.ones(len(all_times), dtype=bool)
+            is_transition[1:] = np.any(state_matrix[1:] != state_matrix[:-1], axis=1)
+
+            # Pack the state of each transition into an integer, with chan 1 in the least significant bit
+            channel_weights = 1 << np.arange(nchan, dtype=np.uint64)
+            state_words = (state_matrix[is_transition].astype(np.uint64) * channel_weights).sum(axis=1).tolist()
+
+            # Converting the original units of the transtion times in seconds, to 1/10th micro-seconds
+            times_usecs = [ int(time * 1E7) for time in all_times[is_transition] ]
 
             # TODO: depending on the hardware there is a limit number of states allowed.
             # For example, the lines below limits the number of the CMOD's 1800 states table to just 510:
-            binary_rows = binary_rows[0:510]
+            state_words = state_words[0:510]
             times_usecs = times_usecs[0:510]
 
             # Write to a list with states in HEX form.
-            stl = ''
-            for time, state in zip(times_usecs, binary_rows):
-                stl += f"{time},{int(state, 2):08X}\n"
+            stl = ''.join([ f"{time},{state_word:08X}\n" for time, state_word in zip(times_usecs, state_words) ])
 
             site_node.STL.record = stl
 
@@ -1310,11 +1446,14 @@ class ACQ2106(MDSplus.Device):
                     except MDSplus.TreeNNF:
                         pass
 
+                running_node = self.device.RUNNING
+                delay = self.device._MONITOR_DELAY_SECONDS
+
                 # One Segment = One Hour
-                segment_size = 3600 / self.device._MONITOR_DELAY_SECONDS
+                segment_size = 3600 / delay
 
                 # TODO: Account for the time it takes to store the data
-                while self.device.RUNNING.on:
+                while running_node.on:
                     now = time.time()
 
                     sys_temp = self.device._string_to_dict(uut.s0.SYS_TEMP)
@@ -1332,11 +1471,10 @@ class ACQ2106(MDSplus.Device):
                             node.putRow(segment_size, float(sys_temp[name]), now)
 
                     # TODO: Account for the time it took to write the temperatures
-                    time.sleep(self.device._MONITOR_DELAY_SECONDS)
+                    time.sleep(delay)
 
             except Exception as e:
-                self.exception = e
-                traceback.print_exc()
+                _report_thread_exception(self, e)
 
     class StreamWriter(threading.Thread):
         def __init__(self, reader):
@@ -1355,25 +1493,27 @@ class ACQ2106(MDSplus.Device):
                 if uut is None:
                     raise Exception(f"Unable to connect to digitizer ({self.device.ADDRESS.data()})")
 
-                input_nodes = []
+                input_nodes = self.device._get_input_nodes(uut)
                 resampled_nodes = []
                 resample_factors = []
                 software_decimations = []
-                for site in list(map(int, uut.get_aggregator_sites())):
-                    site_node = self.device.getNode(f"SITE{site}")
-                    client = uut.modules[site]
-                    site_nchan = int(client.NCHAN)
-                    for input_index in range(site_nchan):
-                        input_node = site_node.getNode(f"INPUT_{input_index + 1:02}")
-                        input_nodes.append(input_node)
-                        
-                        resampled_nodes.append(input_node.RESAMPLED)
-                        resample_factors.append(int(input_node.RES_FACTOR.data()))
-                        software_decimations.append(int(input_node.SOFT_DECIM.data()))
+                for input_node in input_nodes:
+                    resampled_nodes.append(input_node.RESAMPLED)
+                    resample_factors.append(int(input_node.RES_FACTOR.data()))
+                    software_decimations.append(int(input_node.SOFT_DECIM.data()))
+
+                # Check which inputs are on once, instead of querying the tree for every input of every segment
+                active_inputs = [
+                    (input_index, input_node, resampled_nodes[input_index], resample_factors[input_index], software_decimations[input_index])
+                    for input_index, input_node in enumerate(input_nodes)
+                    if input_node.on
+                ]
+
+                scratchpad_node = self.device.SCRATCHPAD
 
                 spad_nodes = []
                 for spad_index in range(self.device._MAX_SPAD):
-                    spad_node = self.device.SCRATCHPAD.getNode(f"SPAD{spad_index}")
+                    spad_node = scratchpad_node.getNode(f"SPAD{spad_index}")
                     if spad_index < self.reader.nspad:
                         spad_nodes.append(spad_node)
                     else:
@@ -1392,6 +1532,14 @@ class ACQ2106(MDSplus.Device):
 
                 event_name = self.device.STREAM.EVENT_NAME.data()
 
+                # This queries the digitizer, so only ask once
+                data_size = uut.data_size()
+
+                # Scratch space for the shifted 32-bit data, allocated once and reused for every segment
+                shifted_int32 = None
+                if data_size == 4:
+                    shifted_int32 = np.empty(self.reader.segment_size // 4, dtype='int32')
+
                 segment_index = 0
                 while True:
                     try:
@@ -1406,36 +1554,39 @@ class ACQ2106(MDSplus.Device):
                     benchmark_start = time.time()
 
                     # Used by both 32-bit input modules and the SPAD
-                    data_int32 = np.frombuffer(buffer, dtype='int32')
+                    data_int32 = None
 
                     data = None
                     samples_per_row = 0
-                    if uut.data_size() == 4:
-                        data = np.right_shift(data_int32, 8)
+                    if data_size == 4:
+                        data_int32 = np.frombuffer(buffer, dtype='int32')
+                        data = np.right_shift(data_int32, 8, out=shifted_int32)
                         samples_per_row = self.reader.nchan + self.reader.nspad
                     else:
                         data = np.frombuffer(buffer, dtype='int16')
+                        data_int32 = data.view('int32') # Reinterpret the same memory for the 32-bit SPAD
                         samples_per_row = self.reader.nchan + (self.reader.nspad * 2) # spad is 32bit, so we need to double it
 
                     # Credit to Mark W. for this masterpiece
                     # data for channel N is data_reshaped[:, N]
                     data_reshaped = np.reshape(data, (self.reader.segment_length, samples_per_row,))
 
-                    for input_index, input_node in enumerate(input_nodes):
-                        if input_node.on:
-                            segment_length = self.reader.segment_length / software_decimations[input_index]
-                            input_delta_time = delta_time * software_decimations[input_index]
-                            input_data = data_reshaped[:: software_decimations[input_index], input_index]
+                    for input_index, input_node, resampled_node, resample_factor, software_decimation in active_inputs:
+                        segment_length = self.reader.segment_length / software_decimation
+                        input_delta_time = delta_time * software_decimation
 
-                            begin = (segment_index * segment_length * input_delta_time) + time_at_0
-                            end = begin + ((segment_length - 1) * input_delta_time)
-                            dim = MDSplus.Range(begin, end, input_delta_time)
+                        # Only copy the samples of active inputs that are kept after decimation, one channel at a time
+                        input_data = np.ascontiguousarray(data_reshaped[:: software_decimation, input_index])
 
-                            input_node.makeSegmentResampled(begin, end, dim, input_data, resampled_nodes[input_index], resample_factors[input_index])
+                        begin = (segment_index * segment_length * input_delta_time) + time_at_0
+                        end = begin + ((segment_length - 1) * input_delta_time)
+                        dim = MDSplus.Range(begin, end, input_delta_time)
+
+                        input_node.makeSegmentResampled(begin, end, dim, input_data, resampled_node, resample_factor)
 
                     if self.reader.nspad > 0:
                         spad_nchan = self.reader.nchan
-                        if uut.data_size() == 2:
+                        if data_size == 2:
                             # Account for 16 bit channels
                             spad_nchan /= 2
                         
@@ -1444,12 +1595,15 @@ class ACQ2106(MDSplus.Device):
 
                         data_spad_reshaped = np.reshape(data_int32, (self.reader.segment_length, spad_samples_per_row,))[:, spad_nchan :]
 
+                        # The data for SPAD N is the contiguous row spad_data[N]
+                        spad_data = np.ascontiguousarray(data_spad_reshaped.T)
+
                         begin = segment_index * self.reader.segment_length * delta_time
                         end = begin + ((self.reader.segment_length - 1) * delta_time)
                         dim = MDSplus.Range(begin, end, delta_time)
 
                         for spad_index in range(self.reader.nspad):
-                            spad_nodes[spad_index].makeSegment(begin, end, dim, data_spad_reshaped[:, spad_index])
+                            spad_nodes[spad_index].makeSegment(begin, end, dim, spad_data[spad_index])
 
                     benchmark_end = time.time()
                     benchmark_elapsed = benchmark_end - benchmark_start
@@ -1461,8 +1615,7 @@ class ACQ2106(MDSplus.Device):
                     MDSplus.Event(event_name)
 
             except Exception as e:
-                self.exception = e
-                traceback.print_exc()
+                _report_thread_exception(self, e)
 
     class StreamReader(threading.Thread):
 
@@ -1474,12 +1627,7 @@ class ACQ2106(MDSplus.Device):
 
         def run(self):
             import acq400_hapi
-            
-            try:
-                from fractions import gcd
-            
-            except:
-                from math import gcd
+            from math import lcm
 
             try:
                 self.tree = MDSplus.Tree(self.tree_name, self.tree_shot)
@@ -1489,16 +1637,13 @@ class ACQ2106(MDSplus.Device):
                 if uut is None:
                     raise Exception(f"Unable to connect to digitizer ({self.device.ADDRESS.data()})")
 
-                self.full_buffer_queue = queue.Queue()
-                self.empty_buffer_queue = queue.Queue()
+                self.full_buffer_queue = queue.SimpleQueue()
+                self.empty_buffer_queue = queue.SimpleQueue()
 
-                software_decimations = []
-                for site in list(map(int, uut.get_aggregator_sites())):
-                    site_node = self.device.getNode(f"SITE{site}")
-                    client = uut.modules[site]
-                    for input_index in range(int(client.NCHAN)):
-                        input_node = site_node.getNode(f"INPUT_{input_index + 1:02}")
-                        software_decimations.append(int(input_node.SOFT_DECIM.data()))
+                software_decimations = [
+                    int(input_node.SOFT_DECIM.data())
+                    for input_node in self.device._get_input_nodes(uut)
+                ]
 
                 # Determine how many extra SPAD channels there are
                 # [0] is 1=enabled/0=disabled
@@ -1518,9 +1663,7 @@ class ACQ2106(MDSplus.Device):
                 bytes_per_row = int(uut.s0.ssb)
 
                 # Find the lowest common decimator
-                decimator = 1
-                for soft_decim in software_decimations:
-                    decimator = int(decimator * soft_decim / gcd(decimator, soft_decim))
+                decimator = lcm(*software_decimations) if software_decimations else 1
                 self.device._log_info(f"Calculated a greatest common decimator of {decimator}")
 
                 self.segment_length = int(self.device.STREAM.SEGLEN_CONF.data())
@@ -1536,6 +1679,11 @@ class ACQ2106(MDSplus.Device):
 
                 self.segment_size = self.segment_length * bytes_per_row
 
+                # Allocate the buffers up front, so that we only need to allocate more if the StreamWriter can't keep up
+                # Buffers are passed around as memoryviews, so they can be sliced for recv_into() without copying
+                for _ in range(self.device._STREAM_BUFFER_COUNT):
+                    self.empty_buffer_queue.put(memoryview(bytearray(self.segment_size)))
+
                 self.writer = self.device.StreamWriter(self)
                 self.writer.setDaemon(True)
                 self.writer.start()
@@ -1543,6 +1691,11 @@ class ACQ2106(MDSplus.Device):
                 # When TRIGGER.SOURCE is set to STRIG, opening the socket will actually trigger the device, so we have to do this last
                 self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
                 self.socket.settimeout(6) # TODO: Investigate making this configurable or something
+
+                # This has to be set before connecting, so the TCP window can be scaled to match
+                # Ask for room for at least one whole segment, so each segment can be drained in as few recv_into() calls as possible
+                socket_buffer_size = max(self.segment_size, self.device._STREAM_SOCKET_BUFFER_SIZE)
+                self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, socket_buffer_size)
                 self.socket.connect((self.device.ADDRESS.data(), acq400_hapi.AcqPorts.STREAM))
 
                 segment_index = 0
@@ -1553,13 +1706,12 @@ class ACQ2106(MDSplus.Device):
                         buffer = self.empty_buffer_queue.get(block=False)
                     except queue.Empty:
                         self.device._log_verbose(f"No empty buffers available, creating new one of {self.segment_size} bytes")
-                        buffer = bytearray(self.segment_size)
+                        buffer = memoryview(bytearray(self.segment_size))
 
-                    bytes_needed = self.segment_size
+                    offset = 0
                     try:
-                        view = memoryview(buffer)
-                        while bytes_needed > 0:
-                            bytes_read = self.socket.recv_into(view, bytes_needed)
+                        while offset < self.segment_size:
+                            bytes_read = self.socket.recv_into(buffer[offset:], self.segment_size - offset)
 
                             #if bytes_read == 0 and not self.running:
                             if bytes_read == 0 and not self.device.RUNNING.on:
@@ -1570,8 +1722,7 @@ class ACQ2106(MDSplus.Device):
                                 first_recv = False
                                 self.device.TRIGGER.TIMESTAMP.record = time.time()
 
-                            view = view[bytes_read:]
-                            bytes_needed -= bytes_read
+                            offset += bytes_read
 
                     except socket.timeout:
                         self.device._log_warning("Socket connection timed out, retrying")
@@ -1580,7 +1731,7 @@ class ACQ2106(MDSplus.Device):
 
                     except socket.error:
                         # TODO: Handle Partial Segments?
-                        # self.full_buffer_queue.put(buffer[:self.segment_size - bytes_needed])
+                        # self.full_buffer_queue.put(buffer[:offset])
                         self.full_buffer_queue.put(None)
                         raise
 
@@ -1591,8 +1742,7 @@ class ACQ2106(MDSplus.Device):
                         self.device._log_info(f"Finished reading segment {segment_index}/{self.segment_count}")
 
             except Exception as e:
-                self.exception = e
-                traceback.print_exc()
+                _report_thread_exception(self, e)
 
             # This will stop the digitizer from streaming
             self.socket.close()
@@ -1602,18 +1752,15 @@ class ACQ2106(MDSplus.Device):
             self.device.RUNNING.on = False
 
             # Wait for the StreamWriter to finish
-            try:
-                while self.writer.is_alive():
-                    pass
-            finally:
-                self.writer.join()
-                if hasattr(self.writer, "exception"):
-                    self.exception = self.writer.exception
+            self.writer.join()
+            if hasattr(self.writer, "exception"):
+                self.exception = self.writer.exception
 
     ###
     ### Streaming Methods
     ###
 
+    @_forget_uut_on_error
     def start_stream(self):
         if self.MODE.data().upper() != 'STREAM':
             raise Exception('Device is not configured for streaming. Set MODE to "STREAM" and then run configure().')
@@ -1657,6 +1804,7 @@ class ACQ2106(MDSplus.Device):
     ### Transient Methods
     ###
 
+    @_forget_uut_on_error
     def arm_transient(self):
         mode = str(self.MODE.data()).upper()
         if mode != 'TRANSIENT':
@@ -1689,7 +1837,7 @@ class ACQ2106(MDSplus.Device):
             highway = 'd1'
             uut.s0.SIG_EVENT_SRC_1 = 'TRG' # System trigger, configured by _set_sync_role
         
-        for site in list(map(int, uut.get_aggregator_sites())):
+        for site in self._get_aggregator_sites(uut):
             client = uut.modules[site]
             
             client.EVENT0          = 'enable'
@@ -1700,6 +1848,7 @@ class ACQ2106(MDSplus.Device):
 
     ARM_TRANSIENT = arm_transient
 
+    @_forget_uut_on_error
     def store_transient(self):
         import acq400_hapi
 
@@ -1707,18 +1856,24 @@ class ACQ2106(MDSplus.Device):
         if mode != 'TRANSIENT':
             raise Exception('Device is not configured for transient recording. Set MODE to "TRANSIENT" and then run configure().')
 
+        address = self.ADDRESS.data()
         uut = self._get_uut()
         if uut is None:
-            raise Exception(f"Unable to connect to digitizer ({self.ADDRESS.data()})")
+            raise Exception(f"Unable to connect to digitizer ({address})")
 
         #mgt = acq400_hapi.Mgt508('mgt508-005')
 
         self.RUNNING.on = False
 
-        # Wait for post-processing to finish
-        # TODO: Timeout?
+        # Wait for post-processing to finish, backing off between polls so we don't flood the digitizer with requests
+        poll_delay = self._POST_PROCESSING_MIN_POLL_SECONDS
+        deadline = time.monotonic() + self._POST_PROCESSING_TIMEOUT_SECONDS
         while uut.statmon.get_state() != 0:
-            pass
+            if time.monotonic() > deadline:
+                raise Exception(f"Timed out after {self._POST_PROCESSING_TIMEOUT_SECONDS} seconds waiting for post-processing to finish")
+
+            time.sleep(poll_delay)
+            poll_delay = min(poll_delay * 2, self._POST_PROCESSING_MAX_POLL_SECONDS)
         
         # Use the actual counts for pre/post samples, not the requested
         # presamples = int(mgt.s0.TRANS_ACT_PRE.split(' ')[1])
@@ -1745,39 +1900,30 @@ class ACQ2106(MDSplus.Device):
         mds_range = MDSplus.Range(None, None, clock_period)
         mds_dim = MDSplus.Dimension(mds_window, mds_range)
 
-        input_nodes = []
-        for site in list(map(int, uut.get_aggregator_sites())): # TODO: sorted() ?
-            site_node = self.getNode(f"SITE{site}")
-            client = uut.modules[site]
-            site_nchan = int(client.NCHAN)
-            for input_index in range(site_nchan):
-                input_node = site_node.getNode(f"INPUT_{input_index + 1:02}")
-                input_nodes.append(input_node)
+        input_nodes = self._get_input_nodes(uut)
 
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         sock.settimeout(6) # TODO: Investigate making this configurable or something
-        sock.connect((self.ADDRESS.data(), acq400_hapi.AcqPorts.DATA0))
+        sock.connect((address, acq400_hapi.AcqPorts.DATA0))
         #sock.connect(('mgt508-005', acq400_hapi.Mgt508Ports.READ))
 
         bytes_per_row = int(uut.s0.ssb)
         total_samples = (presamples + postsamples)
         total_bytes = bytes_per_row * total_samples
-        buffer = bytearray(total_bytes)
+        # np.empty skips the zero-fill that bytearray does, the whole buffer is normally overwritten by recv_into
+        buffer = np.empty(total_bytes, dtype=np.uint8)
         view = memoryview(buffer)
 
+        offset = 0
         try:
-            bytes_needed = total_bytes
-            while bytes_needed > 0:
-                bytes_read = sock.recv_into(view, bytes_needed)
+            while offset < total_bytes:
+                bytes_read = sock.recv_into(view[offset:], total_bytes - offset)
                 if bytes_read == 0:
                     break
-                
-                print(f"Read {bytes_read} bytes ({total_bytes - bytes_needed}/{total_bytes})")
-                
-                self._log_verbose(f"Read {bytes_read} bytes ({total_bytes - bytes_needed}/{total_bytes})")
 
-                view = view[bytes_read:]
-                bytes_needed -= bytes_read
+                self._log_verbose(f"Read {bytes_read} bytes ({offset}/{total_bytes})")
+
+                offset += bytes_read
         
         except socket.timeout:
             # TODO:
@@ -1787,6 +1933,9 @@ class ACQ2106(MDSplus.Device):
             # TODO:
             pass
 
+        # Zero whatever wasn't received, rather than storing uninitialized memory
+        buffer[offset :] = 0
+
         # Determine how many extra SPAD channels there are
         # [0] is 1=enabled/0=disabled
         # [1] is the number of SPAD channels
@@ -1798,8 +1947,10 @@ class ACQ2106(MDSplus.Device):
         data_int32 = np.frombuffer(buffer, dtype='int32')
 
         data = None
-        nchan = uut.nchan()
-        if uut.data_size() == 4:
+        chan_per_row = uut.nchan()
+        nchan = chan_per_row
+        data_size = uut.data_size()
+        if data_size == 4:
             data = np.right_shift(data_int32, 8)
             nchan -= nspad
         else:
@@ -1808,10 +1959,12 @@ class ACQ2106(MDSplus.Device):
 
         # Credit to Mark W. for this masterpiece
         # data for channel N is data_reshaped[:, N]
-        chan_per_row = uut.nchan()
         data_reshaped = np.reshape(data, (total_samples, chan_per_row,))
 
         for input_index, input_node in enumerate(input_nodes):
+            # Only make one channel contiguous at a time, a copy of the whole capture could be GB in size
+            input_data = np.ascontiguousarray(data_reshaped[:, input_index])
+
             signal = MDSplus.Signal(
                 MDSplus.ADD(
                     MDSplus.MULTIPLY(
@@ -1820,14 +1973,14 @@ class ACQ2106(MDSplus.Device):
                     ),
                     input_node.OFFSET
                 ),
-                data_reshaped[:, input_index],
+                input_data,
                 mds_dim
             )
             input_node.putData(signal)
             
         if nspad > 0:
             spad_nchan = nchan
-            if uut.data_size() == 2:
+            if data_size == 2:
                 # Account for 16 bit channels
                 spad_nchan /= 2
 
@@ -1835,11 +1988,16 @@ class ACQ2106(MDSplus.Device):
             spad_chan_per_row = spad_nchan + nspad
 
             data_spad_reshaped = np.reshape(data_int32, (total_samples, spad_chan_per_row,))[:, spad_nchan :]
+
+            # The data for SPAD N is the contiguous row spad_data[N]
+            spad_data = np.ascontiguousarray(data_spad_reshaped.T)
             
+            scratchpad_node = self.SCRATCHPAD
+
             for spad_index in range(self._MAX_SPAD):
-                spad_node = self.SCRATCHPAD.getNode(f"SPAD{spad_index}")
+                spad_node = scratchpad_node.getNode(f"SPAD{spad_index}")
                 if spad_index < nspad:
-                    signal = MDSplus.Signal(data_spad_reshaped[:, spad_index], None, mds_dim)
+                    signal = MDSplus.Signal(spad_data[spad_index], None, mds_dim)
                     spad_node.putData(signal)
                 else:
                     # Turn off the unused SPAD nodes
@@ -1850,6 +2008,7 @@ class ACQ2106(MDSplus.Device):
 
     STORE_TRANSIENT = store_transient
 
+    @_forget_uut_on_error
     def soft_trigger(self):
         uut = self._get_uut()
         if uut is None:
@@ -1864,6 +2023,7 @@ class ACQ2106(MDSplus.Device):
     SOFT_TRIGGER = soft_trigger
 
     # TODO: Improve based on user feedback
+    @_forget_uut_on_error
     def arm_pulse_generators(self):
         uut = self._get_uut()
         if uut is None:
@@ -1873,6 +2033,7 @@ class ACQ2106(MDSplus.Device):
 
     ARM_PULSE_GENERATORS = arm_pulse_generators
 
+    @_forget_uut_on_error
     def send_wrtd_message(self, message):
         uut = self._get_uut()
         if uut is None:
@@ -1882,6 +2043,7 @@ class ACQ2106(MDSplus.Device):
 
     SEND_WRTD_MESSAGE = send_wrtd_message
 
+    @_forget_uut_on_error
     def get_state(self):
         uut = self._get_uut()
         if uut is None:
@@ -1899,6 +2061,7 @@ class ACQ2106(MDSplus.Device):
 
     GET_STATE = get_state
 
+    @_forget_uut_on_error
     def configure(self, tcl_arguments=None, **kwargs):
         import acq400_hapi
         import socket
@@ -1919,14 +2082,15 @@ class ACQ2106(MDSplus.Device):
         if 'delete_nodes' in kwargs and self._to_bool(kwargs['delete_nodes']):
             delete_nodes = True
 
-        # The list of all nodes added during configure() has to contain the root device node as well
-        self._configure_nodes = [self]
+        # The set of all nids added during configure() has to contain the root device node as well
+        self._configure_nids = { self.nid }
+        self._eval_globals = None
 
-        # Ensure that any new nodes in the parts array are taken care of, and add the original parts array to _configure_nodes
+        # Ensure that any new nodes in the parts array are taken care of, and add the original parts array to _configure_nids
         self._add_parts(self.parts, overwrite_data)
 
         # Add the default parts that are not included in the parts array
-        self._add_parts(self._default_parts, overwrite_data)
+        self._add_parts(self._get_default_parts(), overwrite_data)
 
         # Ensure the RUNNING node is off by default
         # TODO: Add on/off to the parts array?
@@ -1939,9 +2103,9 @@ class ACQ2106(MDSplus.Device):
 
         # Mode-Specific Configuration
 
-        self.MODE.record = str(self.MODE.data()).upper()
-
-        mode = self.MODE.data()
+        # Read MODE once, it is passed down to everything that depends on it
+        mode = str(self.MODE.data()).upper()
+        self.MODE.record = mode
         if mode == 'STREAM':
             self._add_parts(self._stream_parts, overwrite_data)
         elif mode == 'TRANSIENT':
@@ -1957,22 +2121,16 @@ class ACQ2106(MDSplus.Device):
             self._log_warning('ADDRESS is blank, will configure offline.')
             online = False
 
-        if online:
-            # Attempt to resolve the name so we can give a better error
-            try:
-                socket.gethostbyname(str(address))
-            except:
-                self._log_warning(f"ADDRESS '{address}' failed to resolve to an IP, will configure offline.")
-                online = False
-
         if online:
             # Attempt to connect to the device to avoid the long default timeout
+            # This resolves the name as well, and a failure to resolve is reported separately so we can give a better error
             try:
                 self._log_info(f"Testing connection to ADDRESS '{address}'...")
-                test_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                test_socket.settimeout(5)
-                test_socket.connect((self.ADDRESS.data(), acq400_hapi.AcqPorts.SITE0))
+                test_socket = socket.create_connection((str(address), acq400_hapi.AcqPorts.SITE0), timeout=5)
                 test_socket.close()
+            except socket.gaierror:
+                self._log_warning(f"ADDRESS '{address}' failed to resolve to an IP, will configure offline.")
+                online = False
             except OSError:
                 self._log_warning(f"Unable to connect to ADDRESS '{address}', will configure offline.")
                 online = False
@@ -1997,39 +2155,46 @@ class ACQ2106(MDSplus.Device):
 
             self.SERIAL.record = uut.s0.SERIAL
 
-            self._log_info(f"Firmware: {uut.s0.software_version}")
-            self.FIRMWARE.record = uut.s0.software_version
+            firmware = uut.s0.software_version
+            self._log_info(f"Firmware: {firmware}")
+            self.FIRMWARE.record = firmware
 
-            self._log_info(f"FPGA Image: {uut.s0.fpga_version}")
-            self.FPGA_IMAGE.record = uut.s0.fpga_version
+            fpga_image = uut.s0.fpga_version
+            self._log_info(f"FPGA Image: {fpga_image}")
+            self.FPGA_IMAGE.record = fpga_image
 
             has_wr = (uut.s0.has_wr != 'none')
             if has_wr:
                 self._log_info('Detected White Rabbit capabilities')
 
+            # Each site has its own connection to the digitizer, so they can all be queried at once
+            site_clients = sorted(uut.modules.items())
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max(len(site_clients), 1)) as executor:
+                site_probes = list(executor.map(self._probe_site, [ client for _, client in site_clients ]))
+
             # If any site has Signal Conditioning, assume they all do
             # TODO: Possibly improve?
             has_sc = False
-            for site, client in sorted(uut.modules.items()):
-                if not has_sc and 'ELFX32' in client.knobs:
-                    has_sc = self._to_bool(client.ELFX32)
+            modules = dict()
+            for (site, _), (model, elfx32) in zip(site_clients, site_probes):
+                if not has_sc and elfx32 is not None:
+                    has_sc = self._to_bool(elfx32)
                     self._log_info(f"Detected Signal Conditioning capabilities in site {site}")
 
-            modules = dict()
-            for site, client in sorted(uut.modules.items()):
-                model = client.MODEL.split(' ')[0]
                 modules[site] = model
 
                 self._log_info(f"Module found in site {site}: {model}")
 
-                site_parts += self._get_parts_for_site(site, model, has_sc=has_sc)
+            # The parts depend on has_sc, so they can only be generated once every site has been checked
+            for site, model in modules.items():
+                site_parts += self._get_parts_for_site(site, model, mode, has_sc=has_sc)
 
             self.MODULES.record = self._dict_to_string(modules)
 
             data_size = uut.data_size()
             self._log_info(f"Data size is {data_size}")
 
-            aggregator_sites = list(map(int, uut.get_aggregator_sites()))
+            aggregator_sites = list(self._get_aggregator_sites(uut))
             self._log_info(f"Aggregator sites are {aggregator_sites}")
 
         else:
@@ -2059,10 +2224,10 @@ class ACQ2106(MDSplus.Device):
                     model = modules[site]
                     self._log_info(f"Module assumed to be in site {site}: {model}")
 
-                    site_parts += self._get_parts_for_site(site, model, has_sc=has_sc)
+                    site_parts += self._get_parts_for_site(site, model, mode, has_sc=has_sc)
 
                 else:
-                    print(f"No module assumed to be in site {site}")
+                    self._log_info(f"No module assumed to be in site {site}")
 
             # TODO: Approximate uut.data_size()
             data_size = 4
@@ -2116,10 +2281,8 @@ class ACQ2106(MDSplus.Device):
             model = modules[site]
             info = self._get_module_info(model)
 
-            site_node = self.getNode(f"SITE{site}")
-            for input in range(info['nchan']):
-                input_node = site_node.getNode(f"INPUT_{input + 1:02}")
-                all_inputs.append(input_node)
+            site_path = f":SITE{site}"
+            all_inputs += [ self.getNode(site_path + input_suffix) for input_suffix in self._INPUT_SUFFIXES[: info['nchan']] ]
 
         self._log_info(f"Found a total of {len(all_inputs)} aggregated inputs")
 
@@ -2130,8 +2293,8 @@ class ACQ2106(MDSplus.Device):
                     'type': 'structure',
                 }
             ]
-            for input_index, input_node in enumerate(all_inputs):
-                input_path = f":INPUTS:INPUT_{input_index + 1:03}"
+            for input_suffix, input_node in zip(self._AGGREGATED_INPUT_SUFFIXES, all_inputs):
+                input_path = ':INPUTS' + input_suffix
                 input_parts += [
                     {
                         'path': input_path,
@@ -2164,12 +2327,12 @@ class ACQ2106(MDSplus.Device):
 
         # TODO: SPAD
 
-        # TODO: Compare and delete self._configure_nodes
-        all_nids = self.getNodeWild('***').data()
-        new_nids = [ node.nid for node in self._configure_nodes ]
+        # Find every node that wasn't added during configure(), keeping them in tree order so parents come before their children
+        all_nids = np.asarray(self.getNodeWild('***').data(), dtype=np.int32)
+        new_nids = np.fromiter(self._configure_nids, dtype=np.int32, count=len(self._configure_nids))
 
-        bad_nids = set(all_nids) - set(new_nids)
-        bad_paths = [ str(MDSplus.TreeNode(nid, self.tree).path) for nid in bad_nids ]
+        bad_nids = all_nids[~np.isin(all_nids, new_nids)]
+        bad_paths = [ str(MDSplus.TreeNode(nid, self.tree).path) for nid in bad_nids.tolist() ]
         
         if delete_nodes:
             for path in bad_paths:
@@ -2192,6 +2355,7 @@ class ACQ2106(MDSplus.Device):
 
     CONFIGURE = configure
 
+    @_forget_uut_on_error
     def verify(self):
 
         # Verify connectivity
@@ -2211,10 +2375,12 @@ class ACQ2106(MDSplus.Device):
         firmware = uut.s0.software_version
         if firmware != self.FIRMWARE.data():
             self._log_warning('The Firmware Version has changed, it is recommended that you run configure() again.')
+            self._forget_uut()
 
         fpga_image = uut.s0.fpga_version
         if fpga_image != self.FPGA_IMAGE.data():
             self._log_warning('The FPGA image has changed, it is recommended that you run configure() again.')
+            self._forget_uut()
 
         # Verify the configured modules
 
@@ -2231,39 +2397,43 @@ class ACQ2106(MDSplus.Device):
         # if self.HARD_DECIM.data() > 16 and self.FREQUENCY.data() < 10000:
         #     self._log_warning('Using Hardware Decimation > 16 with a Frequency of < 10000 will cause data loss.')
 
-        for node in self.getNodeWild('***'):
+        # Only NUMERIC and TEXT nodes have limits, so let MDSplus filter by usage instead of checking every node
+        for node in self.getNodeWild('***', 'NUMERIC'):
             self._log_verbose(f"Verifying configuration for {node.path}")
 
-            if node.usage not in [ 'NUMERIC', 'TEXT' ]:
+            try:
+                value = node.data()
+            except MDSplus.TreeNODATA:
                 continue
 
+            min_value = node.getExtendedAttribute('min')
+            if min_value is not None:
+                if value < min_value:
+                    raise Exception(f"Node {node.path} has invalid value of {value}, must be >= {min_value}")
+
+            max_value = node.getExtendedAttribute('max')
+            if max_value is not None:
+                if value > max_value:
+                    raise Exception(f"Node {node.path} has invalid value of {value}, must be <= {max_value}")
+
+            values = node.getExtendedAttribute('values')
+            if values is not None:
+                if value not in values:
+                    raise Exception(f"Node {node.path} has invalid value of {value}, must be one of {list(values)}")
+
+        for node in self.getNodeWild('***', 'TEXT'):
+            self._log_verbose(f"Verifying configuration for {node.path}")
+
             try:
                 value = node.data()
             except MDSplus.TreeNODATA:
                 continue
 
-            if node.usage == 'NUMERIC':
-                min_value = node.getExtendedAttribute('min')
-                if min_value is not None:
-                    if value < min_value:
-                        raise Exception(f"Node {node.path} has invalid value of {value}, must be >= {min_value}")
-
-                max_value = node.getExtendedAttribute('max')
-                if max_value is not None:
-                    if value > max_value:
-                        raise Exception(f"Node {node.path} has invalid value of {value}, must be <= {max_value}")
-
-                values = node.getExtendedAttribute('values')
-                if values is not None:
-                    if value not in values:
-                        raise Exception(f"Node {node.path} has invalid value of {value}, must be one of {list(values)}")
-
-            elif node.usage == 'TEXT':
-                values = node.getExtendedAttribute('values')
-                # TODO: Maybe compare case insensitive?
-                if values is not None:
-                    if value not in values:
-                        raise Exception(f"Node {node.path} has invalid value of {value}, must be one of {list(values)}")
+            values = node.getExtendedAttribute('values')
+            # TODO: Maybe compare case insensitive?
+            if values is not None:
+                if value not in values:
+                    raise Exception(f"Node {node.path} has invalid value of {value}, must be one of {list(values)}")
 
         # Verify the configured mode based on the nodes that should be there
 
@@ -2312,21 +2482,109 @@ class ACQ2106(MDSplus.Device):
     def _log_error(self, format, *args):
         self.dprint(1, format, *args)
 
+    _aggregator_sites_cache = None
+    """The connection to the digitizer and the aggregator sites read from it by the last call to _get_aggregator_sites"""
+
+    def _get_aggregator_sites(self, uut):
+        """Get the aggregated sites as a tuple of ints, only querying the digitizer once per connection"""
+        if self._aggregator_sites_cache is None or self._aggregator_sites_cache[0] is not uut:
+            self._aggregator_sites_cache = (uut, tuple(map(int, uut.get_aggregator_sites())))
+
+        return self._aggregator_sites_cache[1]
+
+    def _get_input_nodes(self, uut):
+        """Get the input nodes of every aggregated site, in the order their channels appear in the data"""
+        input_nodes = []
+        for site in self._get_aggregator_sites(uut): # TODO: sorted() ?
+            site_path = f":SITE{site}"
+            site_nchan = int(uut.modules[site].NCHAN)
+            input_nodes += [ self.getNode(site_path + input_suffix) for input_suffix in self._INPUT_SUFFIXES[:site_nchan] ]
+
+        return input_nodes
+
+    _uut_cache = {}
+    """Connections made by _get_uut and their creation time, keyed by (address, thread) and shared by every instance"""
+
+    _uut_cache_lock = threading.Lock()
+    """Guards _uut_cache, which is shared by every thread"""
+
     def _get_uut(self):
         import acq400_hapi
-        return acq400_hapi.factory(self.ADDRESS.data())
+
+        # Connections are not thread-safe, so each thread gets its own
+        address = self.ADDRESS.data()
+        key = (address, threading.get_ident())
+        self._uut_address = address
+
+        now = time.monotonic()
+        with self._uut_cache_lock:
+            # Drop expired connections, including those of threads that have since exited
+            for cached_key, (_, created) in list(self._uut_cache.items()):
+                if now - created >= self._UUT_CACHE_SECONDS:
+                    del self._uut_cache[cached_key]
+
+            cached = self._uut_cache.get(key)
+            if cached is not None:
+                return cached[0]
+
+        uut = acq400_hapi.factory(address)
+        with self._uut_cache_lock:
+            self._uut_cache[key] = (uut, time.monotonic())
+
+        return uut
+
+    _uut_address = None
+    """The address read by the last call to _get_uut, so that _forget_uut never has to read ADDRESS from inside an error handler"""
+
+    def _forget_uut(self):
+        """Drop every cached connection to this digitizer, so the next call to _get_uut reconnects"""
+        # Nothing was cached by this device if _get_uut was never called
+        address = self._uut_address
+        if address is None:
+            return
+
+        with self._uut_cache_lock:
+            for key in [ key for key in self._uut_cache if key[0] == address ]:
+                del self._uut_cache[key]
+
+    _value_expr_code = {}
+    """Cache of the compiled code for each valueExpr string, see _compile_value_expr"""
+
+    @classmethod
+    def _compile_value_expr(cls, value_expr):
+        """Compile a valueExpr string once, so every part that shares it can reuse the code object"""
+        if value_expr not in cls._value_expr_code:
+            cls._value_expr_code[value_expr] = compile(value_expr, '<valueExpr>', 'eval')
+
+        return cls._value_expr_code[value_expr]
+
+    _package_globals = None
+    """The MDSplus package namespace that the valueExpr globals are copied from, see _get_package_globals"""
+
+    @classmethod
+    def _get_package_globals(cls):
+        """Load the MDSplus package namespace once, it is expensive and the same for every instance"""
+        if cls._package_globals is None:
+            cls._package_globals = MDSplus._mimport('__init__').load_package({})
+
+        return cls._package_globals
+
+    _eval_globals = None
+    """The globals used to evaluate valueExpr, built by the first call to _add_parts and reset by configure()"""
 
     # TODO: Move this into MDSplus.Device?
     def _add_parts(self, parts, overwrite_data=False):
         # See MDSplus.Device.Add
 
         # Configure tree, path, and head as global variables, to be accessed from valueExpr
-        eval_globals = MDSplus._mimport('__init__').load_package({})
-        eval_globals['tree'] = self.tree
-        eval_globals['path'] = self.path
-        eval_globals['head'] = self
+        # The shared package namespace is copied once per configure(), so neither these nor eval's __builtins__ ever modify it
+        if self._eval_globals is None:
+            self._eval_globals = dict(self._get_package_globals(), tree=self.tree, path=self.path, head=self)
+
+        eval_globals = self._eval_globals
 
-        # First, add all the nodes
+        # First, add all the nodes, keeping them so they don't need to be looked up again
+        part_nodes = []
         for part in parts:
             try:
                 node = self.addNode(part['path'], part.get('type', 'none'))
@@ -2337,31 +2595,34 @@ class ACQ2106(MDSplus.Device):
                 node.on = True # In case it was turned off by `delete_nodes=False`
                 self._log_verbose(f"Found {node.path}")
 
-        # Then you can reference them in valueExpr
-        for part in parts:
-            node = self.getNode(part['path'])
-            self._configure_nodes.append(node)
+                # New nodes are added with the right usage, only existing ones need to be checked
+                usage = part.get('type', 'none').upper()
+                if node.getUsage() != usage:
+                    node.setUsage(usage)
 
-            # TODO: Port this back into Tree.py
-            eval_globals['node'] = node
+            part_nodes.append(node)
 
-            usage = part.get('type', 'none').upper()
-            if node.getUsage() != usage:
-                node.setUsage(usage)
+        # Then you can reference them in valueExpr
+        for part, node in zip(parts, part_nodes):
+            self._configure_nids.add(node.nid)
 
             if 'options' in part:
                 # print(f"Setting options of {node.path}: {part['options']}")
+                # Reading a flag is cheaper than writing it, so only write the ones that aren't already set
                 for option in part['options']:
-                    node.__setattr__(option, True)
-
-            # HACK: Part of a hack to circumvent XNCI's from destroying data
-            # Can be removed after https://github.com/MDSplus/mdsplus/pull/2498 is merged
-            try:
-                data = node.getDataNoRaise()
-            except MDSplus.TreeBADRECORD:
-                pass
+                    if not getattr(node, option):
+                        setattr(node, option, True)
 
+            data = None
             if 'ext_options' in part:
+                # HACK: Part of a hack to circumvent XNCI's from destroying data
+                # Can be removed after https://github.com/MDSplus/mdsplus/pull/2498 is merged
+                # Only setting XNCIs destroys data, so the data only needs to be saved and restored for parts with ext_options
+                try:
+                    data = node.getDataNoRaise()
+                except MDSplus.TreeBADRECORD:
+                    pass
+
                 # HACK: If no_write_model is set, you are unable to set XNCIs, so we temporarily disable it
                 no_write_model = node.no_write_model
                 node.no_write_model = False
@@ -2379,7 +2640,9 @@ class ACQ2106(MDSplus.Device):
                     node.record = part['value']
                 elif 'valueExpr' in part:
                     self._log_verbose(f"Setting value of {node.path} to expression: {part['valueExpr']}")
-                    node.record = eval(part['valueExpr'], eval_globals)
+                    # TODO: Port this back into Tree.py
+                    eval_globals['node'] = node
+                    node.record = eval(self._compile_value_expr(part['valueExpr']), eval_globals)
 
             # If we are not overwriting the data, set it back to the original
             elif data is not None:
@@ -2396,9 +2659,12 @@ class ACQ2106(MDSplus.Device):
             )
         )
 
+    _TRUE_STRINGS = frozenset([ "1", "true", "yes", "on" ])
+    """The strings, in lowercase, that _to_bool considers to be True"""
+
     def _to_bool(self, value):
-        if value is str:
-            return value.lower() in [ "1", "true" ]
+        if isinstance(value, str):
+            return value.strip().lower() in self._TRUE_STRINGS
         return bool(value)
 
     def _dict_to_string(self, dictionary):
@@ -2409,11 +2675,9 @@ class ACQ2106(MDSplus.Device):
         """Convert a string in the form key1=value1,key2=value2 into a dictionary. See _dict_to_string for the inverse."""
         dictionary = dict()
 
-        pairs = string.split(' ')
-        if len(pairs) == 1:
-            pairs = string.split(',')
-
-        for pair in pairs:
+        # Pairs are separated by spaces, or by commas if there are no spaces
+        separator = ' ' if ' ' in string else ','
+        for pair in string.split(separator):
             if '=' in pair:
                 key, value = pair.split('=')
 